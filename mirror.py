@@ -1,16 +1,44 @@
 #!/usr/bin/env python3
 
+import argparse
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import dataclasses
+import fcntl
+import functools
 import hashlib
+import json
 import logging
+import mmap
 import os
 import shutil
+import ssl
 import sys
+import threading
+import time
+from collections.abc import AsyncIterator, Buffer, Callable, Generator, Iterator
 from http import HTTPStatus
 from pathlib import Path
+from typing import BinaryIO, Protocol, cast
 
 import httpx
 from tqdm.auto import tqdm
 
+try:
+    import blake3
+except ImportError:
+    # BLAKE3 support is optional (archive-mirror[blake3])
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    # XXH3 support is optional (archive-mirror[xxhash])
+    xxhash = None
+
 # Configure logging to output to standard output
 logging.basicConfig(
     level=logging.INFO,
@@ -19,180 +47,1563 @@ logging.basicConfig(
     handlers=[logging.StreamHandler(sys.stdout)],
 )
 
+# Write the response to disk in large blocks to keep per-write overhead low
+CHUNK_SIZE = 1 << 20
+
+# Upper bound on concurrent connections when mirroring many files at once
+MAX_CONNECTIONS = 32
+
+# Upper bound on files fetched at once; each in-flight file holds a temporary
+# file, a lock and up to SMALL_FILE_BYTES of buffer
+MAX_CONCURRENT_FETCHES = 16
+
+# Bodies of known size below this are collected in memory before being written
+SMALL_FILE_BYTES = 64 << 20
+
+# Number of times a download that lost its connection is resumed from where it
+# stopped before giving up
+MAX_RESUMES = 3
+
+# Hash files may list the hash of every CHUNK_HASH_BYTES block of the file
+# after the root hash, the hash of the concatenated block digests
+# ("root:h0:h1:..."). The blocks are then hashed in parallel, and a corrupt
+# block fails the download as soon as it has been hashed.
+CHUNK_HASH_BYTES = 8 << 20
+
+# Minimum number of bytes between two progress bar updates
+PROGRESS_UPDATE_BYTES = 256 << 10
+
+# Interval between progress log messages for downloads of unknown size
+PROGRESS_LOG_SECONDS = 10
+
+# Hash algorithms downloads can be verified with; the cached digest is stored
+# next to the file with the algorithm name as suffix. xxh3 (128-bit XXH3) is
+# not cryptographic, but the fastest way to catch corrupt transfers.
+HASH_ALGORITHMS = ("sha256", "blake3", "xxh3")
+
+# Directories already created by this process, so repeated fetches into the
+# same tree don't re-walk it
+_CREATED_DIRS: set[Path] = set()
+
+# Files whose hash this process checked, by hash cache path, with the size
+# and mtime the file had then and the time.monotonic() of the check
+_CHECKED_FILES: dict[Path, tuple[int, int, float]] = {}
+
+# Hash manifests fetched by this process, by URL, with the cache validators
+# they were served with
+_HASH_MANIFESTS: dict[str, tuple[dict[str, str], dict[str, str]]] = {}
 
-def get_hash_cache_path(output_path: Path) -> Path:
-    return output_path.with_suffix(".sha256")
 
+def get_hash_cache_path(output_path: Path, algorithm: str = "sha256") -> Path:
+    return output_path.with_suffix(f".{algorithm}")
+
+
+def get_hash_meta_path(output_path: Path, algorithm: str = "sha256") -> Path:
+    return output_path.with_suffix(f".{algorithm}.meta")
+
+
+def load_validators(meta_path: Path, url: str) -> dict[str, str]:
+    # The metadata file maps URLs to the HTTP cache validators we last saw
+    validators = _load_meta(meta_path).get(url)
+    if not isinstance(validators, dict):
+        return {}
+
+    items = cast("dict[object, object]", validators).items()
+    return {k: v for k, v in items if isinstance(k, str) and isinstance(v, str)}
+
+
+def save_validators(meta_path: Path, url: str, validators: dict[str, str]) -> None:
+    # The file's mtime doubles as the time the hash was last checked. It
+    # holds the validators of both the hash file and the file itself, so
+    # update our entry and keep the other one.
+    meta = _load_meta(meta_path)
+    if meta.get(url) == validators:
+        touch_validators(meta_path)
+        return
+
+    logging.debug("Saving cache validators for %s to %s", url, meta_path)
+    meta[url] = validators
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+
+def _load_meta(meta_path: Path) -> dict[str, object]:
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    # JSON object keys are always strings
+    return cast("dict[str, object]", meta) if isinstance(meta, dict) else {}
 
+
+def touch_validators(meta_path: Path) -> None:
+    try:
+        os.utime(meta_path)
+    except OSError:
+        logging.debug("Could not update timestamp of %s", meta_path)
+
+
+def response_validators(response: httpx.Response) -> dict[str, str]:
+    validators: dict[str, str] = {}
+    if etag := response.headers.get("etag"):
+        validators["etag"] = etag
+    if last_modified := response.headers.get("last-modified"):
+        validators["last_modified"] = last_modified
+    return validators
+
+
+def conditional_headers(validators: dict[str, str]) -> dict[str, str]:
+    headers: dict[str, str] = {}
+    if etag := validators.get("etag"):
+        headers["If-None-Match"] = etag
+    if last_modified := validators.get("last_modified"):
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+# Mirror runs parse the same hash files over and over; size the cache for
+# manifests of thousands of files, each entry being only a short string
+@functools.lru_cache(maxsize=8192)
 def parse_hash_file(content: str) -> str:
-    parts = content.strip().split()
+    # Format is: "hash filename"; split off the hash only. Unlike partition(),
+    # split(None, 1) skips leading whitespace and ends the hash at any
+    # whitespace, without a strip() copying the content first.
+    parts = content.split(None, 1)
     if not parts:
         msg = "Empty hash file"
         raise ValueError(msg)
-
-    # Format is: "hash filename"
     return parts[0]
 
 
-def fetch_file(url: str, output_path: Path, hash_url: str) -> bool:
-    logging.debug("Starting fetch_file operation")
+def parse_manifest(content: str) -> list[tuple[str, Path, str]]:
+    specs: list[tuple[str, Path, str]] = []
+    for lineno, raw_line in enumerate(content.splitlines(), start=1):
+        line = raw_line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        # Format is: "url<TAB>output_path[<TAB>hash_url]"; the hash URL may be
+        # left out when the hashes come from a hash manifest
+        fields = line.split("\t")
+        if len(fields) not in (2, 3):
+            msg = (
+                f"Invalid manifest line {lineno}: expected 2 or 3 tab-separated fields"
+            )
+            raise ValueError(msg)
+
+        url, output_path, hash_url = (field.strip() for field in [*fields, ""][:3])
+        specs.append((url, Path(output_path).resolve(), hash_url))
+
+    return specs
+
+
+def parse_hash_manifest(content: str) -> dict[str, str]:
+    # Format is one "hash filename" line per file, as written by sha256sum;
+    # map the relative path of each file to its hash
+    hashes: dict[str, str] = {}
+    for raw_line in content.splitlines():
+        # Any whitespace may separate the hash from the name
+        file_hash, name = [*raw_line.split(maxsplit=1), "", ""][:2]
+        if not name or file_hash.startswith("#"):
+            continue
+
+        # sha256sum marks files hashed in binary mode with a leading "*"
+        path = Path(name.strip().removeprefix("*")).as_posix()
+        if hashes.get(path, file_hash) != file_hash:
+            logging.warning("Hash manifest lists %s more than once", path)
+        hashes[path] = file_hash
+
+    return hashes
+
+
+def fetch_hash_manifest(
+    url: str,
+    *,
+    client: httpx.Client | None = None,
+) -> dict[str, str]:
+    # One request for the hashes of every file, instead of one per file. A
+    # manifest we already have is only parsed again if it changed.
+    cached = _HASH_MANIFESTS.get(url)
+    headers = conditional_headers(cached[0]) if cached else {}
+    response = (client or _default_client()).get(
+        url,
+        headers=headers,
+        follow_redirects=True,
+    )
+
+    if cached and response.status_code == HTTPStatus.NOT_MODIFIED:
+        logging.debug("Hash manifest %s hasn't changed", url)
+        return dict(cached[1])
+
+    if response.status_code != HTTPStatus.OK:
+        msg = f"Failed to fetch hash manifest from {url}: {response.status_code}"
+        raise ValueError(msg)
+
+    hashes = parse_hash_manifest(response.text)
+    if validators := response_validators(response):
+        _HASH_MANIFESTS[url] = (validators, hashes)
+    return dict(hashes)
+
+
+@dataclasses.dataclass(frozen=True)
+class _Target:
+    # A file being mirrored, and where its bookkeeping files live. The paths
+    # are derived once per fetch rather than at every use.
+    url: str
+    output_path: Path
+    hash_url: str
+    algorithm: str = "sha256"
+    # Hash known up front (e.g. from a hash manifest), saving the hash request
+    known_hash: str | None = None
+    # Size of the blocks the body is written to disk in
+    chunk_size: int = CHUNK_SIZE
+
+    @functools.cached_property
+    def hash_cache_path(self) -> Path:
+        return get_hash_cache_path(self.output_path, self.algorithm)
+
+    @functools.cached_property
+    def meta_path(self) -> Path:
+        return get_hash_meta_path(self.output_path, self.algorithm)
+
+    @functools.cached_property
+    def downloading_path(self) -> Path:
+        # Name of the temporary file while a download is in flight
+        output_path = self.output_path
+        return output_path.with_suffix(output_path.suffix + ".downloading")
+
+    @functools.cached_property
+    def lock_path(self) -> Path:
+        output_path = self.output_path
+        return output_path.with_suffix(output_path.suffix + ".lock")
+
+    @functools.cached_property
+    def filename(self) -> str:
+        return self.url.rpartition("/")[2]
+
+
+def fetch_file(  # noqa: PLR0913
+    url: str,
+    output_path: Path,
+    hash_url: str,
+    *,
+    cache_ttl: float = 0,
+    algorithm: str = "sha256",
+    expected_hash: str | None = None,
+    client: httpx.Client | None = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> bool:
+    target = _prepare_fetch(
+        url,
+        output_path,
+        hash_url,
+        cache_ttl=cache_ttl,
+        algorithm=algorithm,
+        expected_hash=expected_hash,
+        chunk_size=chunk_size,
+    )
+    if target is None:
+        return False
+
+    with _download_lock(target) as locked:
+        if not locked:
+            return False
+
+        return _fetch_file(client or _default_client(), target)
+
+
+@functools.cache
+def _default_client() -> httpx.Client:
+    # Shared by every fetch that isn't given its own client, so the hash and
+    # the file, and files from the same host, reuse their connections
+    # (multiplexed over HTTP/2 where supported) instead of a handshake each
+    client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=MAX_CONNECTIONS,
+            keepalive_expiry=60,
+        ),
+    )
+    atexit.register(client.close)
+    return client
+
+
+def _fetch_file(client: httpx.Client, target: _Target) -> bool:
+    url = target.url
+    check = _Check(target)
+    if (headers := check.head_headers()) is not None:
+        head_response = client.head(url, headers=headers, follow_redirects=True)
+        if check.not_modified(head_response):
+            return False
+
+    if (headers := check.hash_headers()) is not None:
+        hash_response = client.get(
+            target.hash_url,
+            headers=headers,
+            follow_redirects=True,
+        )
+        check.hash_fetched(hash_response)
+
+    expected_hash = check.download_hash()
+    if expected_hash is None:
+        return False
+
+    with _temp_download(target) as (temp_file, temp_path):
+        # Stream the file to disk to avoid loading the entire file into memory
+        with client.stream("GET", url, follow_redirects=True) as response:
+            download = _start_download(target, response, temp_file, expected_hash)
+            if download is None:
+                return False
+
+            # Take the body as it arrives; _Download coalesces it
+            content_validators = response_validators(response)
+            body = _iter_body(client, url, response, download, content_validators)
+            with _progress_bar(target, download.total_size) as progress:
+                for chunk in body:
+                    download.write(chunk)
+                    progress(len(chunk))
+
+        _verify_download(url, download.finish(), expected_hash)
+        _publish(temp_file, temp_path, target, expected_hash, check.hash_response)
+        _save_fetched(target, check.hash_response, content_validators)
+        return True
+
+
+async def fetch_file_async(  # noqa: PLR0913
+    url: str,
+    output_path: Path,
+    hash_url: str,
+    *,
+    client: httpx.AsyncClient,
+    cache_ttl: float = 0,
+    algorithm: str = "sha256",
+    expected_hash: str | None = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> bool:
+    target = _prepare_fetch(
+        url,
+        output_path,
+        hash_url,
+        cache_ttl=cache_ttl,
+        algorithm=algorithm,
+        expected_hash=expected_hash,
+        chunk_size=chunk_size,
+    )
+    if target is None:
+        return False
+
+    with _download_lock(target) as locked:
+        if not locked:
+            return False
+
+        return await _fetch_file_async(client, target)
+
+
+async def _fetch_file_async(client: httpx.AsyncClient, target: _Target) -> bool:
+    url = target.url
+    check = _Check(target)
+    if (headers := check.head_headers()) is not None:
+        head_response = await client.head(url, headers=headers, follow_redirects=True)
+        if check.not_modified(head_response):
+            return False
+
+    if (headers := check.hash_headers()) is not None:
+        hash_response = await client.get(
+            target.hash_url,
+            headers=headers,
+            follow_redirects=True,
+        )
+        check.hash_fetched(hash_response)
+
+    expected_hash = check.download_hash()
+    if expected_hash is None:
+        return False
+
+    with _temp_download(target) as (temp_file, temp_path):
+        async with client.stream("GET", url, follow_redirects=True) as response:
+            download = _start_download(
+                target,
+                response,
+                temp_file,
+                expected_hash,
+                blocking=False,
+            )
+            if download is None:
+                return False
+
+            content_validators = response_validators(response)
+            body = _aiter_body(client, url, response, download, content_validators)
+            with _progress_bar(target, download.total_size) as progress:
+                async for chunk in body:
+                    download.write(chunk)
+                    progress(len(chunk))
+                    # Write and hash full blocks off the event loop
+                    if download.backlogged:
+                        await asyncio.to_thread(download.drain)
+
+        # Hash the last block, sync to disk and publish off the event loop
+        # (publishing may have to copy the whole file), so other downloads
+        # keep making progress
+        downloaded_hash = await asyncio.to_thread(download.finish)
+        _verify_download(url, downloaded_hash, expected_hash)
+        await asyncio.to_thread(
+            _publish,
+            temp_file,
+            temp_path,
+            target,
+            expected_hash,
+            check.hash_response,
+        )
+        _save_fetched(target, check.hash_response, content_validators)
+        return True
+
+
+def _prepare_fetch(  # noqa: PLR0913
+    url: str,
+    output_path: Path,
+    hash_url: str,
+    *,
+    cache_ttl: float,
+    algorithm: str,
+    expected_hash: str | None,
+    chunk_size: int,
+) -> _Target | None:
+    # The part of a fetch that needs no I/O of the client; None if the file
+    # was checked recently enough to skip it
+    logging.debug("Starting fetch operation")
     logging.debug("URL: %s", url)
     logging.debug("Output path: %s", output_path)
     logging.debug("Hash URL: %s", hash_url)
 
-    if not hash_url:
-        raise ValueError("hash_url must be provided")
+    if not hash_url and expected_hash is None:
+        msg = "hash_url must be provided"
+        raise ValueError(msg)
+    _check_algorithm(algorithm)
+
+    target = _Target(
+        url,
+        output_path,
+        hash_url,
+        algorithm,
+        expected_hash,
+        chunk_size,
+    )
+
+    # Skip all network traffic if the hash was checked recently
+    if _is_fresh(target, cache_ttl):
+        return None
 
     # Create parent directory if it doesn't exist
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-    logging.debug("Output directory exists: %s", output_path.parent)
+    _ensure_dir(output_path.parent)
+    return target
 
-    # Path for storing the hash
-    hash_cache_path = get_hash_cache_path(output_path)
 
-    # Fetch the expected hash
-    with httpx.Client() as client:
-        hash_response = client.get(hash_url, follow_redirects=True)
-        if hash_response.status_code != HTTPStatus.OK:
-            msg = f"Failed to fetch hash from {hash_url}: {hash_response.status_code}"
-            raise ValueError(msg)
+async def fetch_many(
+    specs: list[tuple[str, Path, str]],
+    *,
+    cache_ttl: float = 0,
+    algorithm: str = "sha256",
+    hashes: dict[str, str] | None = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> list[bool | BaseException]:
+    # Overlap the downloads over a shared connection pool; one failure
+    # shouldn't abort the other transfers
+    limits = httpx.Limits(max_connections=MAX_CONNECTIONS)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+
+    async def fetch(url: str, output_path: Path, hash_url: str) -> bool:
+        async with semaphore:
+            return await fetch_file_async(
+                url,
+                output_path,
+                hash_url,
+                client=client,
+                cache_ttl=cache_ttl,
+                algorithm=algorithm,
+                expected_hash=_lookup_hash(hashes, url, hash_url),
+                chunk_size=chunk_size,
+            )
+
+    async with httpx.AsyncClient(
+        http2=True,
+        limits=limits,
+    ) as client:
+        return await asyncio.gather(
+            *(fetch(*spec) for spec in specs),
+            return_exceptions=True,
+        )
+
+
+def _lookup_hash(
+    hashes: dict[str, str] | None,
+    url: str,
+    hash_url: str,
+) -> str | None:
+    if hashes is None:
+        return None
+
+    # The manifest lists paths relative to wherever it was generated; take the
+    # longest one the URL path ends with, so files of the same name in
+    # different directories keep their own hashes
+    parts = httpx.URL(url).path.split("/")
+    for start in range(1, len(parts)):
+        if (file_hash := hashes.get("/".join(parts[start:]))) is not None:
+            return file_hash
+
+    # A file missing from the manifest can still have a hash file of its own
+    if hash_url:
+        return None
+    msg = f"{url} is not listed in the hash manifest"
+    raise ValueError(msg)
+
+
+def _ensure_dir(path: Path) -> None:
+    if path in _CREATED_DIRS:
+        return
+
+    path.mkdir(parents=True, exist_ok=True)
+    logging.debug("Output directory exists: %s", path)
+    _CREATED_DIRS.add(path)
+
+
+def _is_fresh(target: _Target, cache_ttl: float) -> bool:
+    if cache_ttl <= 0:
+        return False
+
+    age = _checked_age(target)
+    if age is None or age >= cache_ttl:
+        return False
+
+    logging.info(
+        "Hash of %s was checked %.0fs ago (cache TTL %.0fs), skipping check",
+        target.url,
+        age,
+        cache_ttl,
+    )
+    return True
 
-        # Parse the hash file (format: "hash filename")
+
+def _checked_age(target: _Target) -> float | None:
+    # Seconds since the hash of the file was last checked. A check made by
+    # this process is remembered in memory, as long as the file wasn't changed
+    # since, so it costs a single stat().
+    output_path = target.output_path
+    checked = _CHECKED_FILES.get(target.hash_cache_path)
+    if checked is not None:
+        size, mtime_ns, checked_at = checked
         try:
-            expected_hash = parse_hash_file(hash_response.text)
-        except ValueError as e:
-            msg = f"Invalid hash file format: {e}"
-            raise ValueError(msg) from e
+            stat = output_path.stat()
+        except OSError:
+            return None
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            return None
+        return time.monotonic() - checked_at
 
-        if not expected_hash:
-            msg = f"Empty hash received from {hash_url}"
-            raise ValueError(msg)
+    hash_cache_path = target.hash_cache_path
+    if not (output_path.exists() and hash_cache_path.exists()):
+        return None
+
+    # The metadata file records when the hash was last checked; fall back to
+    # the hash cache itself for files mirrored before it existed
+    meta_path = target.meta_path
+    checked_path = meta_path if meta_path.exists() else hash_cache_path
+    try:
+        return time.time() - checked_path.stat().st_mtime
+    except OSError:
+        return None
+
+
+def _remember_checked(target: _Target) -> None:
+    try:
+        stat = target.output_path.stat()
+    except OSError:
+        return
+    checked = (stat.st_size, stat.st_mtime_ns, time.monotonic())
+    _CHECKED_FILES[target.hash_cache_path] = checked
+
+
+def local_digest(path: Path, algorithm: str = "sha256") -> str:
+    # Hash a mirrored file from its mapped pages, without copying it through
+    # Python buffers
+    _check_algorithm(algorithm)
+    with open(path, "rb") as f:
+        return _file_digest(f, algorithm)
 
-    # Check if file exists locally and compare with cached hash
-    if output_path.exists() and hash_cache_path.exists():
+
+def batch_verify(
+    specs: list[tuple[Path, str]],
+    *,
+    algorithm: str = "sha256",
+) -> list[bool]:
+    _check_algorithm(algorithm)
+
+    def verify(spec: tuple[Path, str]) -> bool:
+        path, expected_hash = spec
         try:
-            with open(hash_cache_path) as f:
-                cached_hash = parse_hash_file(f.read())
+            return _file_hash_matches(path, algorithm, expected_hash)
+        except OSError:
+            return False
 
-            if cached_hash == expected_hash:
-                logging.info(
-                    "File %s hasn't changed (hash match), skipping download",
-                    url,
-                )
-                return False
-        except (OSError, ValueError):
-            # If we can't read the hash cache or it's invalid, continue with download
-            logging.warning(
-                "Could not read hash cache at %s, will download file",
-                hash_cache_path,
-            )
+    # hashlib and blake3 release the GIL while hashing, so a thread pool hashes
+    # several files at once on a multi-core host
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        return list(pool.map(verify, specs))
+
+
+class _Check:
+    # Decides whether a file needs downloading, from the answers to the
+    # requests it asks for; the sync and async fetches only differ in how
+    # they send them
+
+    def __init__(self, target: _Target) -> None:
+        self.target = target
+        self.expected_hash = target.known_hash
+        self.head_response: httpx.Response | None = None
+        self.hash_response: httpx.Response | None = None
+        self.hash_request_headers: dict[str, str] = {}
+
+    def head_headers(self) -> dict[str, str] | None:
+        # Ask the server whether the file itself changed since we mirrored it;
+        # if not, we don't even need its hash. A hash we were given settles
+        # that offline, and a 304 could only hide our copy not matching it.
+        if self.expected_hash is not None:
+            return None
+        return _content_request_headers(self.target) or None
+
+    def not_modified(self, head_response: httpx.Response) -> bool:
+        self.head_response = head_response
+        return _is_not_modified(self.target, head_response)
+
+    def hash_headers(self) -> dict[str, str] | None:
+        # Fetch the expected hash, unless we were given it
+        if self.expected_hash is not None:
+            return None
+        self.hash_request_headers = _hash_request_headers(self.target)
+        return self.hash_request_headers
 
-    # Create the output directory if it doesn't exist
-    output_dir = output_path.parent
-    os.makedirs(output_dir, exist_ok=True)
+    @functools.cached_property
+    def cached_hash_file(self) -> str | None:
+        return _read_hash_cache(self.target)
 
-    # Use a consistent temporary filename with `.downloading` suffix as a lock
-    downloading_path = output_path.with_suffix(output_path.suffix + ".downloading")
+    def hash_fetched(self, hash_response: httpx.Response) -> None:
+        self.hash_response = hash_response
 
-    # Check if another process is already downloading this file
-    if downloading_path.exists():
+        # The cache holds the hash file as it was served; an identical one
+        # needs no parsing at all
+        if (
+            hash_response.status_code == HTTPStatus.OK
+            and hash_response.text == self.cached_hash_file
+        ):
+            _mark_unchanged(self.target, hash_response)
+            return
+
+        self.expected_hash = _expected_hash(
+            self.target,
+            hash_response,
+            self.hash_request_headers,
+        )
+
+    def download_hash(self) -> str | None:
+        # The hash to verify a download against, or None if our copy is
+        # up to date
+        target = self.target
+        expected_hash = self.expected_hash
+        if expected_hash is None or _is_unchanged(
+            target,
+            expected_hash,
+            self.cached_hash_file,
+            self.hash_response,
+        ):
+            _save_content_validators(target, self.head_response)
+            return None
+
+        logging.info("Will download to %s after verification", target.output_path)
+        return expected_hash
+
+
+def _content_request_headers(target: _Target) -> dict[str, str]:
+    if target.output_path.exists() and target.hash_cache_path.exists():
+        return conditional_headers(load_validators(target.meta_path, target.url))
+    return {}
+
+
+def _is_not_modified(target: _Target, response: httpx.Response) -> bool:
+    if response.status_code != HTTPStatus.NOT_MODIFIED:
+        return False
+
+    logging.info("File %s hasn't changed (not modified), skipping download", target.url)
+    touch_validators(target.meta_path)
+    _remember_checked(target)
+    return True
+
+
+def _save_content_validators(
+    target: _Target,
+    head_response: httpx.Response | None,
+) -> None:
+    # The file changed on the server as far as its validators go, but our copy
+    # still matches its hash; remember the new validators so the next check
+    # is a single 304 again
+    if head_response is not None and head_response.status_code == HTTPStatus.OK:
+        content_validators = response_validators(head_response)
+        save_validators(target.meta_path, target.url, content_validators)
+
+
+def _hash_request_headers(target: _Target) -> dict[str, str]:
+    # If we already have the file, let the server tell us the hash is unchanged
+    if target.output_path.exists() and target.hash_cache_path.exists():
+        return conditional_headers(load_validators(target.meta_path, target.hash_url))
+    return {}
+
+
+def _expected_hash(
+    target: _Target,
+    hash_response: httpx.Response,
+    headers: dict[str, str],
+) -> str | None:
+    hash_url = target.hash_url
+    if headers and hash_response.status_code == HTTPStatus.NOT_MODIFIED:
         logging.info(
-            "Another process is already downloading %s (lock file %s exists)",
-            url,
-            downloading_path,
+            "File %s hasn't changed (hash not modified), skipping download",
+            target.url,
+        )
+        touch_validators(target.meta_path)
+        _remember_checked(target)
+        return None
+
+    if hash_response.status_code != HTTPStatus.OK:
+        msg = f"Failed to fetch hash from {hash_url}: {hash_response.status_code}"
+        raise ValueError(msg)
+
+    # Parse the hash file (format: "hash filename")
+    try:
+        expected_hash = parse_hash_file(hash_response.text)
+    except ValueError as e:
+        msg = f"Invalid hash file format: {e}"
+        raise ValueError(msg) from e
+
+    if not expected_hash:
+        msg = f"Empty hash received from {hash_url}"
+        raise ValueError(msg)
+
+    return expected_hash
+
+
+def _read_hash_cache(target: _Target) -> str | None:
+    # Check if file exists locally and read its cached hash file
+    hash_cache_path = target.hash_cache_path
+    if not (target.output_path.exists() and hash_cache_path.exists()):
+        return None
+
+    try:
+        with open(hash_cache_path) as f:
+            return f.read()
+    except OSError:
+        # If we can't read the hash cache, continue with download
+        logging.warning(
+            "Could not read hash cache at %s, will download file",
+            hash_cache_path,
         )
+        return None
+
+
+def _is_unchanged(
+    target: _Target,
+    expected_hash: str,
+    cached_hash_file: str | None,
+    hash_response: httpx.Response | None,
+) -> bool:
+    if cached_hash_file is None:
         return False
 
-    logging.info("Creating temporary file at %s", downloading_path)
-    logging.info("Will download to %s after verification", output_path)
+    try:
+        unchanged = parse_hash_file(cached_hash_file) == expected_hash
+    except ValueError:
+        # If the hash cache is invalid, continue with download
+        logging.warning(
+            "Could not read hash cache at %s, will download file",
+            target.hash_cache_path,
+        )
+        return False
 
-    # Create the temporary file
-    with open(downloading_path, "wb") as temp_file:
-        # Stream the file to disk to avoid loading the entire file into memory
-        sha256 = hashlib.sha256()
-        success = False
+    if not unchanged:
+        return False
+
+    _mark_unchanged(target, hash_response)
+    return True
 
-        try:
-            # Use HTTP client to stream the file
-            with (
-                httpx.Client() as client,
-                client.stream("GET", url, follow_redirects=True) as response,
-            ):
-                # If there was an error, bail
-                if response.status_code != HTTPStatus.OK:
-                    logging.error(
-                        "Error fetching %s: %s",
-                        url,
-                        response.status_code,
-                    )
-                    return False
-
-                # Get total size if available
-                total_size = int(response.headers.get("content-length", 0)) or None
-
-                # Set up progress bar description
-                desc = f"Downloading {url.split('/')[-1]}"
-
-                # Use progress bar for streaming download
-                with tqdm(
-                    total=total_size,
-                    unit="B",
-                    unit_scale=True,
-                    unit_divisor=1024,
-                    desc=desc,
-                    # Auto-disable in non-interactive sessions
-                    disable=None,
-                ) as progress_bar:
-                    for chunk in response.iter_bytes(chunk_size=8192):
-                        temp_file.write(chunk)
-                        sha256.update(chunk)
-                        progress_bar.update(len(chunk))
-                        # Ensure data is written to disk
-                        temp_file.flush()
-
-            # Verify hash
-            downloaded_hash = sha256.hexdigest()
-            if downloaded_hash != expected_hash:
-                logging.warning("Hash mismatch for %s", url)
-                logging.warning("Expected: %s", expected_hash)
-                logging.warning("Got: %s", downloaded_hash)
-                msg = f"Hash mismatch for {url}"
-                raise ValueError(msg)
 
-            # If we got here, the download was successful and hash matches
-            success = True
+def _mark_unchanged(target: _Target, hash_response: httpx.Response | None) -> None:
+    logging.info("File %s hasn't changed (hash match), skipping download", target.url)
+    if hash_response is not None:
+        hash_validators = response_validators(hash_response)
+        save_validators(target.meta_path, target.hash_url, hash_validators)
+    _remember_checked(target)
+
+
+@contextlib.contextmanager
+def _download_lock(target: _Target) -> Generator[bool]:
+    # Hold an flock() on a lock file for the whole fetch. Unlike checking for
+    # the existence of a file, the kernel drops the lock if we crash, so a
+    # leftover lock file never blocks later runs.
+    lock_path = target.lock_path
+    flags = os.O_RDWR | os.O_CREAT | os.O_CLOEXEC
+    try:
+        fd = os.open(lock_path, flags, 0o644)
+    except FileNotFoundError:
+        # The directory was removed since we created it; forget it and
+        # create it again
+        _CREATED_DIRS.discard(lock_path.parent)
+        _ensure_dir(lock_path.parent)
+        fd = os.open(lock_path, flags, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # The previous holder removes the file before unlocking it; make
+            # sure we didn't lock a file that is no longer there
+            locked = os.stat(lock_path).st_ino == os.fstat(fd).st_ino
+        except (BlockingIOError, FileNotFoundError):
+            locked = False
 
-            # Move the temporary file to the final destination
+        if not locked:
             logging.info(
-                "Moving temporary file from %s to %s",
-                downloading_path,
-                output_path,
+                "Another process is already downloading %s (lock file %s is held)",
+                target.url,
+                lock_path,
             )
-            shutil.move(downloading_path, output_path)
+            yield False
+            return
 
-            # Store the hash in cache file with proper format
-            logging.info("Saving hash to %s", hash_cache_path)
-            with open(hash_cache_path, "w") as f:
-                f.write(f"{expected_hash}  {output_path}")
+        try:
+            yield True
+        finally:
+            lock_path.unlink(missing_ok=True)
+    finally:
+        os.close(fd)
 
-            logging.info("Successfully downloaded %s to %s", url, output_path)
-            return success
 
+def _open_temp_file(target: _Target) -> tuple[BinaryIO, Path | None]:
+    # On Linux, download into an unnamed file in the output directory; it only
+    # gets a name once it has been verified, so nothing is left behind if we
+    # crash halfway through
+    parent = target.output_path.parent
+    if hasattr(os, "O_TMPFILE") and os.path.isdir("/proc/self/fd"):
+        try:
+            fd = os.open(
+                parent,
+                os.O_TMPFILE | os.O_RDWR | os.O_CLOEXEC,
+                0o644,
+            )
+        except OSError:
+            # Not every filesystem supports O_TMPFILE
+            logging.debug("O_TMPFILE not supported in %s", parent)
+        else:
+            logging.info("Creating temporary file in %s", parent)
+            return os.fdopen(fd, "w+b"), None
+
+    downloading_path = target.downloading_path
+    logging.info("Creating temporary file at %s", downloading_path)
+    return open(downloading_path, "w+b"), downloading_path
+
+
+@contextlib.contextmanager
+def _temp_download(target: _Target) -> Generator[tuple[BinaryIO, Path | None]]:
+    temp_file, temp_path = _open_temp_file(target)
+    with temp_file:
+        try:
+            yield temp_file, temp_path
         finally:
-            # Clean up the temporary file if something went wrong
-            if not success and downloading_path.exists():
+            # Clean up the temporary file if it wasn't published
+            downloading_path = target.downloading_path
+            if downloading_path.exists():
                 logging.info("Cleaning up temporary file %s", downloading_path)
                 os.unlink(downloading_path)
 
 
-def main() -> int:
-    import argparse
+def _content_length(response: httpx.Response) -> int | None:
+    # Get total size if available. Content-Length counts the bytes on the
+    # wire, so it says nothing about the size of a compressed body once
+    # httpx has decoded it.
+    if _is_encoded(response):
+        return None
+    return int(response.headers.get("content-length", 0)) or None
+
+
+def _is_encoded(response: httpx.Response) -> bool:
+    encoding = response.headers.get("content-encoding", "").strip().lower()
+    return encoding not in ("", "identity")
+
+
+def _preallocate(temp_file: BinaryIO, total_size: int | None) -> None:
+    if not total_size:
+        return
+
+    # Reserve the space up front so the filesystem can allocate the file in
+    # one go, and let the kernel know we write it front to back
+    fd = temp_file.fileno()
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, total_size)
+        except OSError:
+            logging.debug("Could not preallocate %d bytes", total_size)
+    if hasattr(os, "posix_fadvise"):
+        with contextlib.suppress(OSError):
+            os.posix_fadvise(fd, 0, total_size, os.POSIX_FADV_SEQUENTIAL)
+
+
+@contextlib.contextmanager
+def _progress_bar(
+    target: _Target,
+    total_size: int | None,
+) -> Generator[Callable[[int], None]]:
+    # Progress reporting is pointless with --quiet
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        yield lambda _: None
+        return
+
+    # Without a total there is no bar worth drawing; log the amount received
+    # every now and then instead
+    if total_size is None:
+        received = 0
+        last_logged = time.monotonic()
+
+        def log_progress(n: int) -> None:
+            nonlocal received, last_logged
+            received += n
+            now = time.monotonic()
+            if now - last_logged >= PROGRESS_LOG_SECONDS:
+                logging.info("Downloaded %d MiB of %s", received >> 20, target.url)
+                last_logged = now
+
+        yield log_progress
+        return
+
+    # A bar is only worth drawing on a terminal; under cron, CI or in a
+    # container don't even set one up
+    if not sys.stderr.isatty():
+        yield lambda _: None
+        return
+
+    # Use progress bar for streaming download, redrawn at most twice a second
+    with tqdm(
+        total=total_size,
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+        desc=f"Downloading {target.filename}",
+        mininterval=0.5,
+    ) as progress_bar:
+        # Every update() takes a lock and may redraw the bar, so only report
+        # progress every PROGRESS_UPDATE_BYTES
+        pending = 0
+
+        def update(n: int) -> None:
+            nonlocal pending
+            pending += n
+            if pending >= PROGRESS_UPDATE_BYTES:
+                progress_bar.update(pending)
+                pending = 0
+
+        yield update
+        progress_bar.update(pending)
+
+
+class _Hash(Protocol):
+    def update(self, data: Buffer, /) -> object: ...
+
+    def hexdigest(self) -> str: ...
+
+
+def _missing_package(algorithm: str) -> str | None:
+    # Name of the optional package the algorithm needs, if it isn't installed
+    if algorithm == "blake3" and blake3 is None:
+        return "blake3"
+    if algorithm == "xxh3" and xxhash is None:
+        return "xxhash"
+    return None
+
+
+def _check_algorithm(algorithm: str) -> None:
+    if algorithm not in HASH_ALGORITHMS:
+        msg = f"Unsupported hash algorithm: {algorithm}"
+        raise ValueError(msg)
+    if package := _missing_package(algorithm):
+        msg = f"The {algorithm} algorithm requires the {package} package"
+        raise ValueError(msg)
+
+
+def _new_hash(algorithm: str, data: Buffer = b"") -> _Hash:
+    if algorithm == "blake3" and blake3 is not None:
+        # BLAKE3 hashes large inputs on several threads, with the GIL released
+        return blake3.blake3(data, max_threads=blake3.blake3.AUTO)
+    if algorithm == "xxh3" and xxhash is not None:
+        return xxhash.xxh3_128(data)
+
+    # The digest is an integrity check, not a security boundary, so FIPS
+    # restrictions on locked-down hosts don't apply to it
+    return hashlib.new(algorithm, data, usedforsecurity=False)
+
+
+def _check_sha256_backend() -> None:
+    # SHA-256 only runs at hardware speed (SHA-NI, ARMv8 crypto extensions)
+    # when hashlib uses OpenSSL rather than its portable builtin fallback
+    if hashlib.sha256.__name__.startswith("openssl_"):
+        logging.debug("Hashing SHA-256 with %s", ssl.OPENSSL_VERSION)
+    else:
+        logging.warning(
+            "hashlib isn't backed by OpenSSL; SHA-256 hashing will be slow, "
+            "consider --algo blake3",
+        )
+
+
+def _file_digest(f: BinaryIO, algorithm: str = "sha256") -> str:
+    # mmap can't map an empty file
+    if not os.fstat(f.fileno()).st_size:
+        return _new_hash(algorithm).hexdigest()
+
+    # Hash the whole mapped file in a single C-level call instead of
+    # calling update() from Python for every chunk
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        return _new_hash(algorithm, mm).hexdigest()
+
+
+def _chunk_hashes(file_hash: str) -> list[str] | None:
+    # The block hashes of a "root:h0:h1:..." hash, if it is one
+    _, sep, chunk_hashes = file_hash.partition(":")
+    return chunk_hashes.split(":") if sep else None
+
+
+@functools.cache
+def _hash_pool() -> concurrent.futures.ThreadPoolExecutor:
+    # Shared by every chunked hash, so concurrent downloads don't each start
+    # a thread per core
+    return concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+@functools.cache
+def _hash_slots() -> threading.Semaphore:
+    # Blocks handed to the pool and not hashed yet, across all downloads;
+    # bounds the memory chunked hashes hold to one block per core
+    return threading.Semaphore(os.cpu_count() or 1)
+
+
+class _ChunkedHash:
+    # Hashes a "root:h0:h1:..." hash: every CHUNK_HASH_BYTES block on its own
+    # thread (hashlib and blake3 release the GIL), each checked against its
+    # published hash as soon as it is done. Blocks wait in ready for a slot in
+    # the pool; a non-blocking hash leaves it to the caller to drain() them,
+    # so the event loop never waits for a slot.
+
+    def __init__(
+        self,
+        url: str,
+        algorithm: str,
+        chunk_hashes: list[str],
+        *,
+        blocking: bool = True,
+    ) -> None:
+        self.url = url
+        self.algorithm = algorithm
+        self.chunk_hashes = chunk_hashes
+        self.blocking = blocking
+        self.block = bytearray()
+        self.ready: collections.deque[bytearray] = collections.deque()
+        self.pending: collections.deque[concurrent.futures.Future[str]] = (
+            collections.deque()
+        )
+        self.hexdigests: list[str] = []
+
+    def update(self, data: Buffer, /) -> None:
+        view = memoryview(data)
+        while view:
+            take = CHUNK_HASH_BYTES - len(self.block)
+            self.block += view[:take]
+            view = view[take:]
+            if len(self.block) == CHUNK_HASH_BYTES:
+                self.ready.append(self.block)
+                self.block = bytearray()
+
+        self._submit_ready(blocking=self.blocking)
+
+        # Fail on finished blocks early
+        self._check(wait=False)
+
+    @property
+    def backlogged(self) -> bool:
+        return bool(self.ready)
+
+    def drain(self) -> None:
+        self._submit_ready(blocking=True)
+        self._check(wait=False)
+
+    def _submit_ready(self, *, blocking: bool) -> None:
+        slots = _hash_slots()
+        while self.ready and slots.acquire(blocking=blocking):
+            future = _hash_pool().submit(self._hash_block, self.ready.popleft())
+            future.add_done_callback(lambda _: slots.release())
+            self.pending.append(future)
+
+    def _hash_block(self, block: bytearray) -> str:
+        return _new_hash(self.algorithm, block).hexdigest()
+
+    def _check(self, *, wait: bool) -> None:
+        while self.pending and (wait or self.pending[0].done()):
+            hexdigest = self.pending.popleft().result()
+            index = len(self.hexdigests)
+            chunk_hashes = self.chunk_hashes
+            expected = chunk_hashes[index] if index < len(chunk_hashes) else None
+            if hexdigest != expected:
+                for future in self.pending:
+                    future.cancel()
+                self.pending.clear()
+                self.ready.clear()
+                msg = f"Hash mismatch for {self.url} in chunk {index}"
+                raise ValueError(msg)
+            self.hexdigests.append(hexdigest)
+            wait = False
+
+    def hexdigest(self) -> str:
+        if self.block:
+            self.ready.append(self.block)
+            self.block = bytearray()
+        while self.ready or self.pending:
+            self._submit_ready(blocking=True)
+            self._check(wait=True)
+
+        digests = b"".join(bytes.fromhex(h) for h in self.hexdigests)
+        root = _new_hash(self.algorithm, digests).hexdigest()
+        return ":".join([root, *self.hexdigests])
+
+
+def _file_hash_matches(path: Path, algorithm: str, expected_hash: str) -> bool:
+    chunk_hashes = _chunk_hashes(expected_hash)
+    if chunk_hashes is None:
+        return local_digest(path, algorithm) == expected_hash
+
+    hasher = _ChunkedHash(str(path), algorithm, chunk_hashes)
+    try:
+        with open(path, "rb") as f:
+            for block in iter(functools.partial(f.read, CHUNK_HASH_BYTES), b""):
+                hasher.update(block)
+        return hasher.hexdigest() == expected_hash
+    except ValueError:
+        return False
+
+
+class _Download:
+    # Receives the body of one download. Small bodies of known size are
+    # collected in a preallocated buffer and written with a single write();
+    # anything else is staged in a reused buffer of the target's chunk size
+    # and written a block at a time. Each block is hashed as it is written,
+    # so the data passes through memory once instead of being read back
+    # after the download, in one C-level update() per block (with the GIL
+    # released) rather than one per network read. A non-blocking download
+    # only queues full blocks, and leaves it to the caller to drain() them off
+    # the event loop; it stages into a second buffer meanwhile.
+
+    def __init__(
+        self,
+        target: _Target,
+        temp_file: BinaryIO,
+        total_size: int | None,
+        expected_hash: str,
+        *,
+        blocking: bool = True,
+    ) -> None:
+        self.url = target.url
+        self.hasher: _Hash = _new_hash(target.algorithm)
+        self.chunked_hash: _ChunkedHash | None = None
+        if chunk_hashes := _chunk_hashes(expected_hash):
+            self.chunked_hash = _ChunkedHash(
+                target.url,
+                target.algorithm,
+                chunk_hashes,
+                blocking=blocking,
+            )
+            self.hasher = self.chunked_hash
+        self.temp_file = temp_file
+        self.total_size = total_size
+        self.blocking = blocking
+        self.received = 0
+        self.buffer: memoryview | None = None
+        self.staging = memoryview(bytearray())
+        self.spare = memoryview(bytearray())
+        self.staged = 0
+        self.ready: collections.deque[bytes | memoryview] = collections.deque()
+
+        if total_size and total_size < SMALL_FILE_BYTES:
+            self.buffer = memoryview(bytearray(total_size))
+        else:
+            self.staging = memoryview(bytearray(target.chunk_size))
+            if not blocking:
+                self.spare = memoryview(bytearray(target.chunk_size))
+            _preallocate(temp_file, total_size)
+
+    def write(self, chunk: bytes) -> None:
+        end = self.received + len(chunk)
+        if self.buffer is None:
+            self._stage(chunk)
+        elif end > len(self.buffer):
+            msg = f"Received more than {len(self.buffer)} bytes from {self.url}"
+            raise ValueError(msg)
+        else:
+            self.buffer[self.received : end] = chunk
+        self.received = end
+
+    @property
+    def backlogged(self) -> bool:
+        # Whether blocks are waiting to be written, or for a slot to be
+        # hashed in
+        return bool(self.ready) or (
+            self.chunked_hash is not None and self.chunked_hash.backlogged
+        )
+
+    def drain(self) -> None:
+        self._write_ready()
+        if self.chunked_hash is not None:
+            self.chunked_hash.drain()
+
+    def _stage(self, chunk: bytes) -> None:
+        if self.staged + len(chunk) > len(self.staging):
+            self._flush_staging()
+            # Blocks at least as large as the buffer gain nothing from copying
+            if len(chunk) >= len(self.staging):
+                self._write_block(chunk)
+                return
+
+        self.staging[self.staged : self.staged + len(chunk)] = chunk
+        self.staged += len(chunk)
+
+    def _flush_staging(self) -> None:
+        if self.staged:
+            self._write_block(self.staging[: self.staged])
+            self.staged = 0
+            # The queued block still holds on to the staging buffer; the
+            # spare one was drained by the caller since it was last queued
+            if not self.blocking:
+                self.staging, self.spare = self.spare, self.staging
+
+    def _write_block(self, block: bytes | memoryview) -> None:
+        self.ready.append(block)
+        if self.blocking:
+            self._write_ready()
+
+    def _write_ready(self) -> None:
+        while self.ready:
+            block = self.ready.popleft()
+            self.hasher.update(block)
+            self.temp_file.write(block)
+
+    def finish(self) -> str:
+        if self.buffer is not None:
+            self._write_block(self.buffer[: self.received])
+        else:
+            self._flush_staging()
+        self._write_ready()
+
+        # Drop any preallocated space the response didn't fill
+        self.temp_file.truncate()
+
+        # Make sure the data is on disk once, before it is published
+        self.temp_file.flush()
+        fd = self.temp_file.fileno()
+        os.fsync(fd)
+
+        # Mirrored files are rarely read back soon; now that the pages are
+        # clean, drop them rather than let them push hotter data out of the
+        # page cache
+        if hasattr(os, "posix_fadvise"):
+            with contextlib.suppress(OSError):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+        return self.hasher.hexdigest()
+
+
+def _start_download(
+    target: _Target,
+    response: httpx.Response,
+    temp_file: BinaryIO,
+    expected_hash: str,
+    *,
+    blocking: bool = True,
+) -> _Download | None:
+    # If there was an error, bail
+    if response.status_code != HTTPStatus.OK:
+        logging.error("Error fetching %s: %s", target.url, response.status_code)
+        return None
+
+    return _Download(
+        target,
+        temp_file,
+        _content_length(response),
+        expected_hash,
+        blocking=blocking,
+    )
+
 
+def _resume_request_headers(
+    url: str,
+    response: httpx.Response,
+    download: _Download,
+    validators: dict[str, str],
+    resumes: int,
+) -> dict[str, str] | None:
+    # Headers of the range request picking up a dropped body, or None if it
+    # can't be resumed. download.received counts decoded bytes, which is no
+    # offset into an encoded body, so those can only start over.
+    if resumes >= MAX_RESUMES or not download.received or _is_encoded(response):
+        return None
+
+    logging.warning(
+        "Connection lost after %d bytes of %s, resuming",
+        download.received,
+        url,
+    )
+
+    # Ask for the rest of the body only; If-Range makes the server send the
+    # whole file instead if it changed since, which we then refuse. Weak ETags
+    # can't be used for range requests.
+    headers = {"Range": f"bytes={download.received}-"}
+    etag = validators.get("etag")
+    if etag and not etag.startswith("W/"):
+        headers["If-Range"] = etag
+    elif last_modified := validators.get("last_modified"):
+        headers["If-Range"] = last_modified
+    return headers
+
+
+def _check_resumed(url: str, response: httpx.Response, offset: int) -> None:
+    content_range = response.headers.get("content-range", "")
+    start = content_range.removeprefix("bytes ").partition("-")[0]
+    if response.status_code != HTTPStatus.PARTIAL_CONTENT or start != str(offset):
+        msg = f"Could not resume download of {url}: {response.status_code}"
+        raise ValueError(msg)
+
+
+def _iter_body(
+    client: httpx.Client,
+    url: str,
+    response: httpx.Response,
+    download: _Download,
+    validators: dict[str, str],
+) -> Iterator[bytes]:
+    # Yield the body of the response; if the connection drops halfway, pick
+    # up where it stopped with a range request. The hasher in download keeps
+    # its state, so the resumed bytes are hashed as if nothing happened.
+    resumes = 0
+    with contextlib.ExitStack() as stack:
+        while True:
+            try:
+                yield from response.iter_bytes()
+            except (httpx.RemoteProtocolError, httpx.ReadError):
+                headers = _resume_request_headers(
+                    url,
+                    response,
+                    download,
+                    validators,
+                    resumes,
+                )
+                if headers is None:
+                    raise
+            else:
+                return
+
+            resumes += 1
+            response.close()
+            response = stack.enter_context(
+                client.stream("GET", url, headers=headers, follow_redirects=True),
+            )
+            _check_resumed(url, response, download.received)
+
+
+async def _aiter_body(
+    client: httpx.AsyncClient,
+    url: str,
+    response: httpx.Response,
+    download: _Download,
+    validators: dict[str, str],
+) -> AsyncIterator[bytes]:
+    resumes = 0
+    async with contextlib.AsyncExitStack() as stack:
+        while True:
+            try:
+                async for chunk in response.aiter_bytes():
+                    yield chunk
+            except (httpx.RemoteProtocolError, httpx.ReadError):
+                headers = _resume_request_headers(
+                    url,
+                    response,
+                    download,
+                    validators,
+                    resumes,
+                )
+                if headers is None:
+                    raise
+            else:
+                return
+
+            resumes += 1
+            await response.aclose()
+            response = await stack.enter_async_context(
+                client.stream("GET", url, headers=headers, follow_redirects=True),
+            )
+            _check_resumed(url, response, download.received)
+
+
+def _verify_download(url: str, downloaded_hash: str, expected_hash: str) -> None:
+    # Verify hash
+    if downloaded_hash != expected_hash:
+        logging.warning("Hash mismatch for %s", url)
+        logging.warning("Expected: %s", expected_hash)
+        logging.warning("Got: %s", downloaded_hash)
+        msg = f"Hash mismatch for {url}"
+        raise ValueError(msg)
+
+
+def _publish(
+    temp_file: BinaryIO,
+    temp_path: Path | None,
+    target: _Target,
+    expected_hash: str,
+    hash_response: httpx.Response | None,
+) -> None:
+    output_path = target.output_path
+    downloading_path = temp_path or target.downloading_path
+    if temp_path is None:
+        # Give the unnamed file a name next to the output file; we hold the
+        # download lock, so nobody else is using it
+        downloading_path.unlink(missing_ok=True)
+        try:
+            os.link(f"/proc/self/fd/{temp_file.fileno()}", downloading_path)
+        except OSError:
+            # Some sandboxes refuse to link through /proc; copy the data instead
+            logging.debug("Could not link temporary file, copying it instead")
+            with open(downloading_path, "wb") as f:
+                _copy_file(temp_file, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+    # Move the temporary file to the final destination; both live in the same
+    # directory, so this is a single atomic rename
+    logging.info(
+        "Moving temporary file from %s to %s",
+        downloading_path,
+        output_path,
+    )
+    os.replace(downloading_path, output_path)
+
+    # Store the hash in cache file, atomically so an interrupted write can't
+    # leave a corrupt cache behind. Keep the hash file as the server sent it,
+    # so an unchanged one is recognised without parsing it.
+    hash_cache_path = target.hash_cache_path
+    temp_hash_path = hash_cache_path.with_suffix(f".{target.algorithm}.tmp")
+    logging.info("Saving hash to %s", hash_cache_path)
+    with open(temp_hash_path, "w") as f:
+        if hash_response is not None:
+            f.write(hash_response.text)
+        else:
+            f.write(f"{expected_hash}  {output_path}")
+    os.replace(temp_hash_path, hash_cache_path)
+    _remember_checked(target)
+
+
+def _save_fetched(
+    target: _Target,
+    hash_response: httpx.Response | None,
+    content_validators: dict[str, str],
+) -> None:
+    # Remember the validators of a published download for the next check
+    if hash_response is not None:
+        hash_validators = response_validators(hash_response)
+        save_validators(target.meta_path, target.hash_url, hash_validators)
+    save_validators(target.meta_path, target.url, content_validators)
+
+    logging.info("Successfully downloaded %s to %s", target.url, target.output_path)
+
+
+def _copy_file(src: BinaryIO, dst: BinaryIO) -> None:
+    # Copy within the kernel (sharing extents where the filesystem supports
+    # reflinks) instead of reading the data through user space
+    size = os.fstat(src.fileno()).st_size
+    offset = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(
+                    src.fileno(),
+                    dst.fileno(),
+                    size - offset,
+                    offset,
+                    offset,
+                )
+                if not copied:
+                    break
+                offset += copied
+        except OSError:
+            logging.debug("copy_file_range not supported, copying through memory")
+
+    # Copy whatever the kernel didn't
+    if offset < size:
+        src.seek(offset)
+        dst.seek(offset)
+        shutil.copyfileobj(src, dst)
+
+
+def main() -> int:
     # Set up argument parser
     parser = argparse.ArgumentParser(description="Mirror a file with hash verification")
-    parser.add_argument("url", help="URL of the file to download")
-    parser.add_argument("output_path", help="Path where to save the file")
-    parser.add_argument("hash_url", help="URL of the file containing the hash")
+    parser.add_argument("url", nargs="?", help="URL of the file to download")
+    parser.add_argument("output_path", nargs="?", help="Path where to save the file")
+    parser.add_argument(
+        "hash_url",
+        nargs="?",
+        help="URL of the file containing the hash",
+    )
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        help="Tab-separated file of 'url output_path hash_url' lines to mirror",
+    )
+    parser.add_argument(
+        "--manifest-url",
+        help="URL of a sha256sum-style file with the hashes of all files, "
+        "fetched once instead of one hash_url per file",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check the manifest's files against their cached hashes, offline",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="Don't re-check the hash of files checked less than SECONDS ago",
+    )
+    parser.add_argument(
+        "--algo",
+        choices=HASH_ALGORITHMS,
+        default="sha256",
+        help="Hash algorithm used by the hash files (default: sha256)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=_positive_int,
+        default=CHUNK_SIZE,
+        metavar="BYTES",
+        help="Size of the blocks downloads are written to disk in "
+        "(default: 1 MiB); lower it on hosts short on memory",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Always check the hash, ignoring --cache-ttl",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -218,14 +1629,78 @@ def main() -> int:
     else:
         logging.getLogger().setLevel(logging.INFO)
 
+    cache_ttl = 0 if args.force else args.cache_ttl
+    algorithm = args.algo
+    if package := _missing_package(algorithm):
+        parser.error(f"--algo {algorithm} requires the {package} package")
+    if algorithm == "sha256":
+        _check_sha256_backend()
+
+    if args.verify:
+        if not args.manifest:
+            parser.error("--verify requires --manifest")
+        return _verify_manifest(Path(args.manifest), algorithm=algorithm)
+
+    if not args.manifest and not (args.url and args.output_path):
+        parser.error("url and output_path are required without --manifest")
+    if not (args.manifest or args.hash_url or args.manifest_url):
+        parser.error("hash_url is required without --manifest-url")
+
+    try:
+        hashes = fetch_hash_manifest(args.manifest_url) if args.manifest_url else None
+    except (httpx.HTTPError, ValueError):
+        logging.exception("Could not fetch hash manifest %s", args.manifest_url)
+        return 1
+
+    if args.manifest:
+        return _mirror_manifest(
+            Path(args.manifest),
+            cache_ttl=cache_ttl,
+            algorithm=algorithm,
+            hashes=hashes,
+            chunk_size=args.chunk_size,
+        )
+
+    return _mirror_file(args, cache_ttl=cache_ttl, algorithm=algorithm, hashes=hashes)
+
+
+def _positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        msg = f"invalid positive integer: {value!r}"
+        raise argparse.ArgumentTypeError(msg)
+    return number
+
+
+def _mirror_file(
+    args: argparse.Namespace,
+    *,
+    cache_ttl: float,
+    algorithm: str,
+    hashes: dict[str, str] | None,
+) -> int:
     # Convert output path to Path object
     output_path = Path(args.output_path).resolve()
 
     logging.info("Starting download of %s to %s", args.url, output_path)
-    logging.info("Using hash URL: %s", args.hash_url)
+    if hashes is None:
+        logging.info("Using hash URL: %s", args.hash_url)
+    else:
+        logging.info("Using hash manifest: %s", args.manifest_url)
 
     try:
-        result = fetch_file(args.url, output_path, args.hash_url)
+        result = fetch_file(
+            args.url,
+            output_path,
+            args.hash_url or "",
+            cache_ttl=cache_ttl,
+            algorithm=algorithm,
+            expected_hash=_lookup_hash(hashes, args.url, args.hash_url or ""),
+            chunk_size=args.chunk_size,
+        )
         if result:
             logging.info("File successfully updated")
         else:
@@ -237,5 +1712,83 @@ def main() -> int:
         return 0
 
 
+def _mirror_manifest(
+    manifest_path: Path,
+    *,
+    cache_ttl: float,
+    algorithm: str,
+    hashes: dict[str, str] | None,
+    chunk_size: int,
+) -> int:
+    try:
+        specs = parse_manifest(manifest_path.read_text())
+    except (OSError, ValueError):
+        logging.exception("Could not read manifest %s", manifest_path)
+        return 1
+
+    logging.info("Mirroring %d files from %s", len(specs), manifest_path)
+    results = asyncio.run(
+        fetch_many(
+            specs,
+            cache_ttl=cache_ttl,
+            algorithm=algorithm,
+            hashes=hashes,
+            chunk_size=chunk_size,
+        ),
+    )
+
+    failed = 0
+    for (url, output_path, _), result in zip(specs, results, strict=True):
+        if isinstance(result, BaseException):
+            failed += 1
+            logging.error(
+                "Error occurred during download of %s",
+                url,
+                exc_info=result,
+            )
+        elif result:
+            logging.info("File %s successfully updated", output_path)
+        else:
+            logging.info("No update needed for %s (file unchanged)", output_path)
+
+    return 1 if failed else 0
+
+
+def _verify_manifest(manifest_path: Path, *, algorithm: str) -> int:
+    try:
+        specs = parse_manifest(manifest_path.read_text())
+    except (OSError, ValueError):
+        logging.exception("Could not read manifest %s", manifest_path)
+        return 1
+
+    # Collect the cached hash of every mirrored file
+    failed = 0
+    checks: list[tuple[Path, str]] = []
+    for _, output_path, _ in specs:
+        hash_cache_path = get_hash_cache_path(output_path, algorithm)
+        try:
+            with open(hash_cache_path) as f:
+                cached_hash = parse_hash_file(f.read())
+        except (OSError, ValueError):
+            cached_hash = None
+
+        if cached_hash is None:
+            failed += 1
+            logging.error("Could not read hash cache at %s", hash_cache_path)
+        else:
+            checks.append((output_path, cached_hash))
+
+    logging.info("Verifying %d files from %s", len(checks), manifest_path)
+    results = batch_verify(checks, algorithm=algorithm)
+    for (output_path, _), ok in zip(checks, results, strict=True):
+        if ok:
+            logging.info("File %s is intact", output_path)
+        else:
+            failed += 1
+            logging.error("File %s is missing or doesn't match its hash", output_path)
+
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -1,32 +1,38 @@
 #!/usr/bin/env python3
 
+import email.utils
 import hashlib
-import http.server
-import socketserver
-import threading
+from pathlib import Path
 
+import httpx
 import pytest
 from _pytest.tmpdir import TempPathFactory
 
 from mirror import fetch_file
 
 
-# ruff: noqa: ANN001, ANN002, ANN003, A002
-# pyright: reportUnknownParameterType=false, reportMissingParameterType=false, reportIncompatibleMethodOverride=false, reportUnknownArgumentType=false, reportUnknownMemberType=false, reportUnknownVariableType=false, reportUnusedImport=false
-class SimpleFileServer(http.server.SimpleHTTPRequestHandler):
-    """Simple HTTP server for testing."""
+def file_server(directory: Path) -> httpx.MockTransport:
+    """Serve the files in a directory, in process, like a static HTTP server."""
 
-    def __init__(self, *args, **kwargs) -> None:
-        # Set directory to the temporary directory
-        directory = kwargs.pop("directory", None)
-        super().__init__(*args, directory=directory, **kwargs)
+    def handler(request: httpx.Request) -> httpx.Response:
+        path = directory / request.url.path.lstrip("/")
+        if not path.is_file():
+            return httpx.Response(404)
 
-    def log_message(self, format, *args) -> None:
-        """Silence the log messages."""
+        # Answer conditional requests the way static file servers do
+        mtime = int(path.stat().st_mtime)
+        headers = {"Last-Modified": email.utils.formatdate(mtime, usegmt=True)}
+        since = request.headers.get("If-Modified-Since")
+        if since and mtime <= email.utils.parsedate_to_datetime(since).timestamp():
+            return httpx.Response(304, headers=headers)
+
+        return httpx.Response(200, headers=headers, content=path.read_bytes())
+
+    return httpx.MockTransport(handler)
 
 
 def test_integration_download(tmp_path_factory: TempPathFactory) -> None:
-    """Integration test for downloading a file from a real HTTP server."""
+    """Integration test for downloading a file from an HTTP server."""
     # Create temporary directories for server and client
     server_dir_path = tmp_path_factory.mktemp("server")
     client_dir_path = tmp_path_factory.mktemp("client")
@@ -41,27 +47,18 @@ def test_integration_download(tmp_path_factory: TempPathFactory) -> None:
     hash_file_path = server_dir_path / "test_file.txt.sha256"
     hash_file_path.write_text(f"{file_hash}  test_file.txt")
 
-    # Start a simple HTTP server in a separate thread
-    def create_handler(*args, **kwargs) -> SimpleFileServer:
-        return SimpleFileServer(*args, directory=str(server_dir_path), **kwargs)
-
-    httpd = socketserver.TCPServer(("localhost", 0), create_handler)
-    port = httpd.server_address[1]
-    server_thread = threading.Thread(target=httpd.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
-
-    try:
-        # Define URLs for the file and its hash
-        base_url = f"http://localhost:{port}"
-        file_url = f"{base_url}/test_file.txt"
-        hash_url = f"{base_url}/test_file.txt.sha256"
+    # Define URLs for the file and its hash
+    base_url = "http://localhost"
+    file_url = f"{base_url}/test_file.txt"
+    hash_url = f"{base_url}/test_file.txt.sha256"
 
-        # Define output path
-        output_path = client_dir_path / "downloaded_file.txt"
+    # Define output path
+    output_path = client_dir_path / "downloaded_file.txt"
 
+    # Route every request of the client to the file server
+    with httpx.Client(transport=file_server(server_dir_path)) as client:
         # Download the file
-        result = fetch_file(file_url, output_path, hash_url)
+        result = fetch_file(file_url, output_path, hash_url, client=client)
 
         # Verify the result
         assert result is True
@@ -73,16 +70,13 @@ def test_integration_download(tmp_path_factory: TempPathFactory) -> None:
         assert hash_cache_path.exists()
         assert file_hash in hash_cache_path.read_text()
 
+        # Verify the server's cache validators were saved for the next run
+        assert output_path.with_suffix(".sha256.meta").exists()
+
         # Test downloading the same file again (should be skipped)
-        result = fetch_file(file_url, output_path, hash_url)
+        result = fetch_file(file_url, output_path, hash_url, client=client)
         assert result is False  # No update needed
 
-    finally:
-        # Shut down the server
-        httpd.shutdown()
-        server_thread.join(timeout=1)
-
 
 if __name__ == "__main__":
     pytest.main(["-v", __file__])
-